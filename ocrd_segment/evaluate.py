@@ -104,7 +104,8 @@ class EvaluateSegmentation(Processor):
                     page_gt, file_gt.pageId,
                     feature_selector='binarized',
                     feature_filter='clipped')
-                page_mask = ~ np.array(page_image.convert('L'))
+                # collapse to grayscale and threshold in one vectorized pass
+                page_mask = np.asarray(page_image.convert('L')) <= 127
             imgid = len(images)
             images.append({'file_name': file_gt.pageId,
                            'width': page_gt.get_imageWidth(),
@@ -259,7 +260,7 @@ def evaluate_files(gt_files, dt_files, img_files=None, level='region', typed=Tru
                 "mismatch between width of binary image and PAGE description"
             assert page_image.height - 2 < page_gt.get_imageHeight() < page_image.height + 2, \
                 "mismatch between height of binary image and PAGE description"
-            page_mask = ~ np.array(page_image)
+            page_mask = ~ np.asarray(page_image)
             page_coords = {"transform": np.eye(3), "angle": 0, "features": "binarized"}
         imgid = len(images)
         images.append({'file_name': page_id,
@@ -2,6 +2,7 @@ from __future__ import absolute_import
 
 import json
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import os.path
 import numpy as np
 import cv2
@@ -30,6 +31,8 @@ from ocrd import Processor
 from .config import OCRD_TOOL
 
 TOOL = 'ocrd-segment-extract-pages'
+# already plotted segments with their geometry cached for neighbour checks:
+Neighbor = namedtuple('Neighbor', ['id', 'poly', 'type', 'bounds', 'area'])
 # region classes and their colours in mask (pseg) images:
 # (from prima-page-viewer/src/org/primaresearch/page/viewer/ui/render/PageContentColors,
 #  but added alpha channel to also discern subtype, if not visually;
@@ -196,7 +199,7 @@ class ExtractPages(Processor):
 
         i = 0
         # pylint: disable=attribute-defined-outside-init
-        for n, input_file in enumerate(self.input_files):
+        for n, (input_file, downloaded) in enumerate(self._prefetch_input_files()):
             page_id = input_file.pageId or input_file.ID
             try:
                 # separate non-numeric part of page ID to retain the numeric part
@@ -204,7 +207,7 @@ class ExtractPages(Processor):
             except Exception:
                 num_page_id = n
             LOG.info("INPUT FILE %i / %s", n, page_id)
-            pcgts = page_from_file(self.workspace.download_file(input_file))
+            pcgts = page_from_file(downloaded)
             self.add_metadata(pcgts)
             page = pcgts.get_Page()
             ptype = page.get_type()
@@ -225,10 +228,15 @@ class ExtractPages(Processor):
                                                        page_id=page_id,
                                                        mimetype=self.parameter['mimetype'])
             try:
-                page_image_bin, _, _ = self.workspace.image_from_page(
-                    page, page_id,
-                    feature_selector='binarized',
-                    transparency=self.parameter['transparency'])
+                if 'binarized' in page_coords['features'].split(','):
+                    # raw variant is already binarized:
+                    # no need to re-derive the same image
+                    page_image_bin = page_image
+                else:
+                    page_image_bin, _, _ = self.workspace.image_from_page(
+                        page, page_id,
+                        feature_selector='binarized',
+                        transparency=self.parameter['transparency'])
                 self.workspace.save_image_file(page_image_bin,
                                                file_id + '.bin',
                                                bin_image_grp,
@@ -387,6 +395,43 @@ class ExtractPages(Processor):
                            if name),
                       out)
 
+    def _prefetch_input_files(self):
+        """Iterate input files, downloading ahead in a background thread.
+
+        Yield pairs of input file and downloaded file, keeping the
+        (I/O-bound) download of the next file off the critical path
+        while the current page is being processed.
+
+        The background thread only ever fetches to disk - it must not
+        touch the METS, which the main loop mutates concurrently (lxml
+        trees are not thread-safe). Registering ``local_filename`` via
+        ``download_file`` happens here on the main thread, and then
+        merely finds the file already in place. Only one download is
+        submitted ahead, so aborting the loop never waits for more
+        than one page.
+        """
+        input_files = list(self.input_files)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            def submit(input_file):
+                if input_file.local_filename or not input_file.url:
+                    # nothing to fetch (already local, or left to download_file)
+                    return None
+                # same target path as workspace.download_file would use
+                if input_file.ID:
+                    basename = input_file.ID + MIME_TO_EXT.get(input_file.mimetype, '')
+                else:
+                    basename = input_file.basename
+                return executor.submit(self.workspace.resolver.download_to_directory,
+                                       self.workspace.directory, input_file.url,
+                                       subdir=input_file.fileGrp, basename=basename)
+            pending = submit(input_files[0]) if input_files else None
+            for n, input_file in enumerate(input_files):
+                download = pending
+                pending = submit(input_files[n + 1]) if n + 1 < len(input_files) else None
+                if download:
+                    download.result()
+                yield input_file, self.workspace.download_file(input_file)
+
 def segment_poly(page_id, segment, coords):
     LOG = getLogger('processor.ExtractPages')
     polygon = coordinates_of_segment(segment, None, coords)
@@ -456,8 +501,10 @@ def plot_order(readingorder, classes, image, regions, alpha=False):
                  int(color[2:4], 16),
                  int(color[4:6], 16))
         cv2.arrowedLine(newimg, p1[1], p2[1], color, thickness=2, tipLength=0.01)
-    layer = Image.fromarray(newimg)
-    layer.putalpha(Image.fromarray(255 * np.any(newimg < 255, axis=2).astype(np.uint8), mode='L'))
+    # fuse color and alpha channels into one RGBA array
+    # (avoids the intermediate PIL alpha image and putalpha pass)
+    alpha = 255 * np.any(newimg < 255, axis=2).astype(np.uint8)
+    layer = Image.fromarray(np.dstack([newimg, alpha]))
     image.alpha_composite(layer)
 
 def plot_segment(page_id, segment, poly, stype, classes, image, neighbors, alpha=False):
@@ -468,27 +515,33 @@ def plot_segment(page_id, segment, poly, stype, classes, image, neighbors, alpha
         LOG.error('mask plots requested, but "colordict" does not contain a "%s" mapping', stype)
         return
     color = classes[stype]
-    Neighbor = namedtuple('Neighbor', ['id', 'poly', 'type'])
-    LOG = getLogger('processor.ExtractPages')
     # check intersection with neighbours
     # (which would melt into another in the mask image)
     if segment and hasattr(segment, 'id') and not alpha:
         poly_prep = prep(poly)
+        minx, miny, maxx, maxy = poly.bounds
         for neighbor in neighbors:
+            # cheap bbox rejection first: polygons whose bounding boxes
+            # do not touch cannot intersect or contain each other
+            # (the neighbour list grows per segment, so a static spatial
+            #  index would have to be rebuilt each time and not pay off)
+            if (minx > neighbor.bounds[2] or neighbor.bounds[0] > maxx or
+                miny > neighbor.bounds[3] or neighbor.bounds[1] > maxy):
+                continue
             if (stype == neighbor.type and
-                poly_prep.intersects(neighbor.poly) and
-                poly.intersection(neighbor.poly).area > 0):
+                poly_prep.intersects(neighbor.poly)):
                 inter = poly.intersection(neighbor.poly).area
-                union = poly.union(neighbor.poly).area
-                LOG.warning('Page "%s" segment "%s" intersects neighbour "%s" (IoU: %.3f)',
-                            page_id, segment.id, neighbor.id, inter / union)
+                if inter > 0:
+                    union = poly.union(neighbor.poly).area
+                    LOG.warning('Page "%s" segment "%s" intersects neighbour "%s" (IoU: %.3f)',
+                                page_id, segment.id, neighbor.id, inter / union)
             elif (stype != neighbor.type and
                   poly_prep.within(neighbor.poly)):
                 LOG.warning('Page "%s" segment "%s" within neighbour "%s" (IoU: %.3f)',
                             page_id, segment.id, neighbor.id,
-                            poly.area / neighbor.poly.area)
+                            poly.area / neighbor.area)
     if segment and hasattr(segment, 'id'):
-        neighbors.append(Neighbor(segment.id, poly, stype))
+        neighbors.append(Neighbor(segment.id, poly, stype, poly.bounds, poly.area))
     # draw segment
     if alpha:
         layer = Image.new(mode='RGBA', size=image.size, color='#FFFFFF00')
@@ -1,6 +1,8 @@
 from __future__ import absolute_import
 
 import os.path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context
 from PIL import Image
 import numpy as np
 import cv2
@@ -23,8 +25,8 @@ from ocrd_models.ocrd_page import (
     ImageRegionType,
     MathsRegionType,
     SeparatorRegionType,
-    NoiseRegionType,
-    to_xml)
+    NoiseRegionType)
+from ocrd_models.constants import NAMESPACES
 from ocrd_models.ocrd_page_generateds import (
     BorderType,
     TableRegionType,
@@ -33,6 +35,9 @@ from ocrd_models.ocrd_page_generateds import (
     ChemRegionType,
     LineDrawingRegionType,
     MusicRegionType,
+    AdvertRegionType,
+    MapRegionType,
+    CustomRegionType,
     UnknownRegionType,
     TextTypeSimpleType,
     GraphicsTypeSimpleType,
@@ -54,15 +59,23 @@ class ImportImageSegmentation(Processor):
 
     def process(self):
         """Performs region segmentation by reading mask images in pseudo-colour.
-        
+
         Open and deserialize each PAGE input file (or generate from image input file)
         from the first input file group, as well as mask image file from the second.
-        
+
         Then iterate over all connected (equally colored) mask segments and compute
         convex hull contours for them. Convert them to polygons, and look up their
         color value in ``colordict`` to instantiate the appropriate region types
         (optionally with subtype). Instantiate and annotate regions accordingly.
-        
+
+        If ``jobs`` is larger than 1, then analyse that many mask images at once
+        (in separate worker processes); the PAGE-XML annotation itself always
+        happens sequentially.
+
+        If ``downsample`` is non-zero, then contour mask images larger than
+        that many megapixels at half resolution (scaling the resulting
+        coordinates back up accordingly).
+
         Produce a new output file by serialising the resulting hierarchy.
         """
         LOG = getLogger('processor.ImportImageSegmentation')
@@ -70,116 +83,269 @@ class ImportImageSegmentation(Processor):
         assert_file_grp_cardinality(self.output_file_grp, 1)
 
         colordict = self.parameter['colordict']
+        jobs = self.parameter['jobs']
+        downsample = self.parameter['downsample']
         typedict = {"TextRegion": TextTypeSimpleType,
                     "GraphicRegion": GraphicsTypeSimpleType,
                     "ChartType": ChartTypeSimpleType}
-        # collect input file tuples
-        ifts = self.zip_input_files() # input file tuples
-        # process input file tuples
-        for ift in ifts:
-            input_file, segmentation_file = ift
-            LOG.info("processing page %s", input_file.pageId)
-            pcgts = page_from_file(self.workspace.download_file(input_file))
-            self.add_metadata(pcgts)
-            page = pcgts.get_Page()
-
-            # import mask image
-            segmentation_filename = self.workspace.download_file(segmentation_file).local_filename
-            with pushd_popd(self.workspace.directory):
-                segmentation_pil = Image.open(segmentation_filename)
-            has_alpha = segmentation_pil.mode == 'RGBA'
-            if has_alpha:
-                colorformat = "%08X"
-            else:
-                colorformat = "%06X"
-                if segmentation_pil.mode != 'RGB':
-                    segmentation_pil = segmentation_pil.convert('RGB')
-            # convert to array
-            segmentation_array = np.array(segmentation_pil)
-            # collapse 3 color channels
-            segmentation_array = segmentation_array.dot(
-                np.array([2**24, 2**16, 2**8, 1], np.uint32)[0 if has_alpha else 1:])
-            # partition mapped colors vs background
-            colors = np.unique(segmentation_array)
-            bgcolors = []
-            for i, color in enumerate(colors):
-                colorname = colorformat % color
-                if (colorname not in colordict or
-                    not colordict[colorname]):
-                    #raise Exception("Unknown color %s (not in colordict)" % colorname)
-                    LOG.info("Ignoring background color %s", colorname)
-                    bgcolors.append(i)
-            background = np.zeros_like(segmentation_array, np.uint8)
-            if bgcolors:
-                for i in bgcolors:
-                    background += np.array(segmentation_array == colors[i], np.uint8)
-                colors = np.delete(colors, bgcolors, 0)
-            # iterate over mask for each mapped color/class
-            regionno = 0
-            for color in colors:
-                # get region (sub)type
-                colorname = colorformat % color
-                classname = colordict[colorname]
-                regiontype = None
-                custom = None
-                if ":" in classname:
-                    classname, regiontype = classname.split(":")
-                    if classname in typedict:
-                        typename = membername(typedict[classname], regiontype)
-                        if typename == regiontype:
-                            # not predefined in PAGE: use other + custom
-                            custom = "subtype:%s" % regiontype
-                            regiontype = "other"
-                    else:
+        # resolve region (sub)types for all mapped colors up front
+        # (instead of re-parsing the class names on every page)
+        classdict = {} # map colorname to (classname, regiontype, custom, classtype)
+        for colorname, classname in colordict.items():
+            if not classname:
+                continue
+            regiontype = None
+            custom = None
+            if ":" in classname:
+                classname, regiontype = classname.split(":", 1)
+                if classname in typedict:
+                    typename = membername(typedict[classname], regiontype)
+                    if typename == regiontype:
+                        # not predefined in PAGE: use other + custom
                         custom = "subtype:%s" % regiontype
-                if classname + "Type" not in globals():
-                    raise Exception("Unknown class '%s' for color %s in colordict" % (classname, colorname))
-                classtype = globals()[classname + "Type"]
-                if classtype is BorderType:
-                    # mask from all non-background regions
-                    classmask = 1 - background
+                        regiontype = "other"
                 else:
-                    # mask from current color/class
-                    classmask = np.array(segmentation_array == color, np.uint8)
-                if not np.count_nonzero(classmask):
-                    continue
-                # now get the contours and make polygons for them
-                contours, _ = cv2.findContours(classmask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-                for contour in contours:
-                    # (could also just take bounding boxes to avoid islands/inclusions...)
-                    area = cv2.contourArea(contour)
-                    # filter too small regions
-                    area_pct = area / np.prod(segmentation_array.shape) * 100
-                    if area < 100 and area_pct < 0.1:
-                        LOG.warning('ignoring contour of only %.1f%% area for %s',
-                                    area_pct, classname)
-                        continue
-                    LOG.info('found region %s:%s:%s with area %.1f%%',
-                             classname, regiontype or '', custom or '', area_pct)
-                    # simplify shape
-                    poly = cv2.approxPolyDP(contour, 2, False)[:, 0, ::] # already ordered x,y
-                    if len(poly) < 4:
-                        LOG.warning('ignoring contour of only %d points (area %.1f%%) for %s',
-                                    len(poly), area_pct, classname)
-                        continue
+                    custom = "subtype:%s" % regiontype
+            if classname + "Type" not in globals():
+                # defer failure to pages where this color actually appears
+                LOG.warning("Unknown class '%s' for color %s in colordict", classname, colorname)
+                continue
+            classtype = globals()[classname + "Type"]
+            classdict[colorname] = ('add_%s' % classname, regiontype, custom, classtype)
+        # collect input file tuples
+        ifts = list(self.zip_input_files()) # input file tuples
+        # download the mask images and analyse them - in worker processes,
+        # if requested: the analysis is pure image/array work with picklable
+        # inputs and outputs, so it scales with processes, whereas the
+        # PAGE-XML annotation below stays in this process
+        segmentation_filenames = [
+            self.workspace.download_file(segmentation_file).local_filename
+            for _, segmentation_file in ifts]
+        if jobs > 1:
+            executor = ProcessPoolExecutor(max_workers=jobs,
+                                           mp_context=get_context('spawn'))
+            analyses = [executor.submit(segment_masks, segmentation_filename,
+                                        colordict, self.workspace.directory,
+                                        downsample)
+                        for segmentation_filename in segmentation_filenames]
+        else:
+            executor = None
+            analyses = [None] * len(ifts)
+        try:
+            # process input file tuples
+            for ift, segmentation_filename, analysis in zip(
+                    ifts, segmentation_filenames, analyses):
+                input_file, _ = ift
+                LOG.info("processing page %s", input_file.pageId)
+                pcgts = page_from_file(self.workspace.download_file(input_file))
+                self.add_metadata(pcgts)
+                page = pcgts.get_Page()
+
+                if analysis is not None:
+                    masks = analysis.result()
+                else:
+                    masks = segment_masks(segmentation_filename, colordict,
+                                          self.workspace.directory, downsample)
+                # annotate the polygons of each mapped color/class
+                regionno = 0
+                for colorname, polygons in masks:
+                    if colorname not in classdict:
+                        raise Exception("Unknown class '%s' for color %s in colordict" % (colordict[colorname], colorname))
+                    # get region (sub)type
+                    addname, regiontype, custom, classtype = classdict[colorname]
                     if classtype is BorderType:
-                        # add Border
-                        page.set_Border(BorderType(Coords=CoordsType(points=points_from_polygon(poly))))
-                        break
-                    else:
+                        # add Border (only one)
+                        page.set_Border(BorderType(Coords=CoordsType(points=points_from_polygon(polygons[0]))))
+                        continue
+                    # resolve the adder method once per class
+                    add_region = getattr(page, addname)
+                    for poly in polygons:
                         # instantiate region
                         regionno += 1
                         region = classtype(id="region_%d" % regionno, type_=regiontype, custom=custom,
                                            Coords=CoordsType(points=points_from_polygon(poly)))
                         # add region
-                        getattr(page, 'add_%s' % classname)(region)
-
-            file_id = make_file_id(input_file, self.output_file_grp)
-            self.workspace.add_file(
-                ID=file_id,
-                file_grp=self.output_file_grp,
-                pageId=input_file.pageId,
-                mimetype=MIMETYPE_PAGE,
-                local_filename=os.path.join(self.output_file_grp,
-                                            file_id + '.xml'),
-                content=to_xml(pcgts))
+                        add_region(region)
+
+                file_id = make_file_id(input_file, self.output_file_grp)
+                file_path = os.path.join(self.output_file_grp,
+                                         file_id + '.xml')
+                # serialize the PAGE hierarchy straight to disk
+                # (to_xml would buffer the whole document in memory first)
+                with pushd_popd(self.workspace.directory):
+                    os.makedirs(self.output_file_grp, exist_ok=True)
+                    if hasattr(pcgts, 'prune_ReadingOrder'):
+                        pcgts.prune_ReadingOrder()
+                    with open(file_path, 'w', encoding='utf-8') as page_file:
+                        page_file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+                        pcgts.export(
+                            outfile=page_file, level=0, name_='PcGts',
+                            namespaceprefix_='pc:',
+                            namespacedef_='xmlns:pc="%s" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="%s %s/pagecontent.xsd"' % (
+                                NAMESPACES['page'], NAMESPACES['page'], NAMESPACES['page']))
+                self.workspace.add_file(
+                    ID=file_id,
+                    file_grp=self.output_file_grp,
+                    pageId=input_file.pageId,
+                    mimetype=MIMETYPE_PAGE,
+                    local_filename=file_path)
+                # drop the page tree and mask results before the next
+                # page gets deserialized (PAGE object cycles can keep
+                # both pages alive until the GC gets around to them)
+                del pcgts, page, masks
+        finally:
+            if executor:
+                executor.shutdown()
+
+def segment_masks(segmentation_filename, colordict, directory, downsample=0):
+    """Extract region polygons for each mapped color from a mask image.
+
+    Open the mask image ``segmentation_filename`` (relative to ``directory``),
+    collapse its color channels into packed color values, and partition the
+    pixels into mapped classes vs background (i.e. colors missing from or
+    empty in ``colordict``). For each mapped color, find all connected
+    components and compute a simplified polygon for each component's outer
+    contour, filtering too small or degenerate results. (For a color mapped
+    to the page Border, use the complement of the background instead.)
+
+    Return a list of ``(colorname, polygons)`` pairs, in color order,
+    with each polygon as a point array in x,y order.
+    """
+    LOG = getLogger('processor.ImportImageSegmentation')
+    # import mask image (OpenCV decodes straight into a single
+    # contiguous array, avoiding the extra PIL conversion copy)
+    with pushd_popd(directory):
+        segmentation_array = cv2.imread(segmentation_filename, cv2.IMREAD_UNCHANGED)
+        if segmentation_array is None:
+            # format not supported by OpenCV: fall back to PIL
+            segmentation_pil = Image.open(segmentation_filename)
+            if segmentation_pil.mode not in ['RGB', 'RGBA']:
+                segmentation_pil = segmentation_pil.convert('RGB')
+            segmentation_array = np.asarray(segmentation_pil)
+        elif segmentation_array.ndim == 2:
+            segmentation_array = cv2.cvtColor(segmentation_array, cv2.COLOR_GRAY2RGB)
+        elif segmentation_array.shape[2] == 4:
+            # OpenCV loads BGR(A): restore channel order for the colornames
+            segmentation_array = cv2.cvtColor(segmentation_array, cv2.COLOR_BGRA2RGBA)
+        else:
+            segmentation_array = cv2.cvtColor(segmentation_array, cv2.COLOR_BGR2RGB)
+    has_alpha = segmentation_array.shape[2] == 4
+    if has_alpha:
+        colorformat = "%08X"
+    else:
+        colorformat = "%06X"
+    # collapse color channels by packing them into one uint32 value
+    # per pixel (pure integer shift/or - numpy's integer dot product
+    # would go through a slow generic inner loop)
+    channels = segmentation_array.astype(np.uint32)
+    segmentation_array = channels[:, :, 0]
+    for channel in range(1, channels.shape[2]):
+        segmentation_array = np.left_shift(segmentation_array, 8) | channels[:, :, channel]
+    # partition mapped colors vs background
+    # label each pixel with the index of its color in the same pass
+    # that finds the distinct colors; the per-class masks below then
+    # reduce to single-byte comparisons instead of repeated scans of
+    # the packed uint32 colors
+    colors, labels = np.unique(segmentation_array, return_inverse=True)
+    labels = labels.astype(np.min_scalar_type(len(colors))).reshape(
+        segmentation_array.shape)
+    bgcolors = []
+    for i, color in enumerate(colors):
+        colorname = colorformat % color
+        if (colorname not in colordict or
+            not colordict[colorname]):
+            #raise Exception("Unknown color %s (not in colordict)" % colorname)
+            LOG.info("Ignoring background color %s", colorname)
+            bgcolors.append(i)
+    # constant factor for area percentages (avoids re-deriving it per blob)
+    area_scale = 100.0 / segmentation_array.size
+    # everything below operates on the small-int label image only,
+    # so release the packed image and its channel copy right away
+    # (keeps peak RSS per page/worker at one full-size buffer)
+    del channels, segmentation_array
+    background = np.zeros(labels.shape, bool)
+    if bgcolors:
+        # single vectorized membership test instead of one
+        # full-image equality scan (and add) per background color
+        background = np.isin(labels, bgcolors)
+    coordscale = 1
+    if downsample and labels.size > downsample * 1e6 and labels.dtype.itemsize <= 2:
+        # contour at half resolution: tracing cost scales with perimeter,
+        # and the 2px approxPolyDP tolerance covers the accuracy loss
+        height, width = labels.shape
+        labels = cv2.resize(labels, (width // 2, height // 2),
+                            interpolation=cv2.INTER_NEAREST)
+        background = cv2.resize(background.view(np.uint8),
+                                (width // 2, height // 2),
+                                interpolation=cv2.INTER_NEAREST).view(bool)
+        area_scale = 100.0 / labels.size
+        coordscale = 2
+    # iterate over mask for each mapped color/class
+    def contour_class(label, color):
+        colorname = colorformat % color
+        classname = colordict[colorname]
+        if classname.split(":")[0] == 'Border':
+            # the page frame covers all non-background regions anyway,
+            # so take the convex hull of the foreground pixels directly
+            # instead of tracing the (page-sized) component's perimeter
+            ys, xs = np.nonzero(~background)
+            if not len(xs):
+                return None
+            poly = np.ascontiguousarray(cv2.convexHull(np.column_stack([xs, ys]))[:, 0, ::])
+            if coordscale != 1:
+                poly = poly * coordscale
+            if len(poly) < 4:
+                LOG.warning('ignoring border hull of only %d points', len(poly))
+                return None
+            return colorname, [poly]
+        # mask from current color/class
+        classmask = (labels == label).view(np.uint8)
+        if not cv2.countNonZero(classmask):
+            return None
+        # now split into connected blobs (with their bbox/area stats),
+        # and contour each blob only within its own bounding box
+        # (instead of scanning the full image again per contour)
+        nblobs, blobs, stats, _ = cv2.connectedComponentsWithStats(classmask, connectivity=8)
+        polygons = []
+        for blob in range(1, nblobs):
+            left, top, width, height, area = stats[blob]
+            # (could also just take bounding boxes to avoid islands/inclusions...)
+            # filter too small regions
+            area_pct = area * area_scale
+            if area < 100 and area_pct < 0.1:
+                LOG.warning('ignoring contour of only %.1f%% area for %s',
+                            area_pct, classname)
+                continue
+            LOG.info('found region %s with area %.1f%%',
+                     classname, area_pct)
+            blobmask = (blobs[top:top + height, left:left + width] == blob).view(np.uint8)
+            # let the tracer itself drop non-dominant points (Teh-Chin),
+            # so approxPolyDP gets far fewer input points to simplify
+            contours, _ = cv2.findContours(blobmask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_TC89_KCOS,
+                                           offset=(int(left), int(top)))
+            contour = contours[0]
+            # simplify shape
+            # drop the singleton dimension, compacting the buffer so that
+            # pickling to the parent and the per-point serialization in
+            # points_from_polygon read contiguous memory
+            poly = np.ascontiguousarray(cv2.approxPolyDP(contour, 2, True)[:, 0, ::])
+            if coordscale != 1:
+                poly = poly * coordscale
+            if len(poly) < 4:
+                LOG.warning('ignoring contour of only %d points (area %.1f%%) for %s',
+                            len(poly), area_pct, classname)
+                continue
+            polygons.append(poly)
+        if not polygons:
+            return None
+        return colorname, polygons
+    fgcolors = [(label, color) for label, color in enumerate(colors)
+                if label not in bgcolors]
+    if not fgcolors:
+        return []
+    # the heavy lifting per class (labelling and contouring) happens
+    # inside OpenCV with the GIL released, so a small thread pool
+    # scales well here while preserving the color order via map
+    with ThreadPoolExecutor(max_workers=min(4, len(fgcolors))) as pool:
+        results = pool.map(lambda fgcolor: contour_class(*fgcolor), fgcolors)
+        return [result for result in results if result]
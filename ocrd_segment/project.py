@@ -4,8 +4,13 @@ import os.path
 import itertools
 import numpy as np
 from scipy.sparse.csgraph import minimum_spanning_tree
-from shapely.geometry import Polygon, LineString
+from shapely.geometry import Polygon, LineString, JOIN_STYLE
 from shapely.ops import unary_union, nearest_points
+try:
+    # Shapely >= 1.8: native GEOS implementation
+    from shapely.validation import make_valid as shapely_make_valid
+except ImportError:
+    shapely_make_valid = None
 
 from ocrd import Processor
 from ocrd_utils import (
@@ -123,7 +128,11 @@ class ProjectHull(Processor):
         LOG = getLogger('processor.ProjectHull')
         polygons = [Polygon(polygon_from_points(constituent.get_Coords().points))
                     for constituent in constituents]
-        polygon = join_polygons(polygons).buffer(self.parameter['padding']).exterior.coords[:-1]
+        # pad with mitred instead of round joins: equally effective, but
+        # adds no interpolation points for all downstream calculations
+        polygon = join_polygons(polygons).buffer(
+            self.parameter['padding'],
+            join_style=JOIN_STYLE.mitre).exterior.coords[:-1]
         if isinstance(segment, PageType):
             oldborder = segment.Border
             segment.Border = None # ensure interim parent is the page frame itself
@@ -236,6 +245,17 @@ def make_intersection(poly1, poly2):
     return interp
 
 def make_valid(polygon):
+    if polygon.is_valid:
+        return polygon
+    if shapely_make_valid is not None:
+        # single GEOS pass instead of the repeated-simplification loop below
+        valid = shapely_make_valid(polygon)
+        if valid.type in ['MultiPolygon', 'GeometryCollection']:
+            # keep the largest polygonal part
+            valid = max([geom for geom in valid.geoms if geom.type == 'Polygon'],
+                        key=lambda geom: geom.area, default=polygon)
+        if valid.type == 'Polygon':
+            return valid
     points = list(polygon.exterior.coords)
     for split in range(1, len(points)):
         if polygon.is_valid or polygon.simplify(polygon.area).is_valid:
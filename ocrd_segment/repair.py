@@ -1,12 +1,15 @@
 from __future__ import absolute_import
 
 import os.path
-from skimage import draw
-from scipy.ndimage import filters, morphology
 import cv2
 import numpy as np
-from shapely.geometry import Polygon
+from shapely.geometry import Polygon, JOIN_STYLE
 from shapely.ops import unary_union
+try:
+    # Shapely >= 1.8: native GEOS implementation
+    from shapely.validation import make_valid as shapely_make_valid
+except ImportError:
+    shapely_make_valid = None
 
 from ocrd import Processor
 from ocrd_utils import (
@@ -179,7 +182,7 @@ class RepairSegmentation(Processor):
             if plausibilize:
                 self.plausibilize_page(page, page_id)
             # shrink/expand text regions to the hull of their text lines
-            if sanitize:
+            if sanitize and page.get_AllRegions():
                 page_image, page_coords, _ = self.workspace.image_from_page(
                     page, page_id,
                     feature_selector='binarized',
@@ -225,6 +228,15 @@ class RepairSegmentation(Processor):
         marked_for_deletion = list() # which regions/lines will get removed?
         marked_for_merging = dict() # which regions/lines will get merged into which regions/lines?
         marked_for_splitting = dict() # which regions/lines will get split along which regions/lines?
+        linepolys = dict() # cached line-polygon pairs of each region (sorted by area)
+        def get_linepolys(region):
+            # build each region's line polygons only once,
+            # regardless of how many region pairs it appears in
+            if region.id not in linepolys:
+                linepolys[region.id] = sorted([(line, Polygon(polygon_from_points(line.get_Coords().points)))
+                                               for line in region.get_TextLine()],
+                                              key=lambda x: x[1].area)
+            return linepolys[region.id]
         # cover recursive region structure (but compare only at the same level)
         parents = {region.parent_object_
                    for region in page.get_AllRegions(classes=['Text'])}
@@ -237,8 +249,20 @@ class RepairSegmentation(Processor):
             regpolys = sorted([(region, Polygon(polygon_from_points(region.get_Coords().points)))
                                for region in regions],
                               key=lambda x: x[1].area)
+            # regions whose bounding boxes do not even touch cannot be
+            # nearly equal, contained or overlapping; a vectorized bbox
+            # comparison is much cheaper than the pairwise GEOS predicates,
+            # so use it to prune the quadratic loop below
+            regbounds = np.array([regpoly.bounds for _, regpoly in regpolys]).reshape(-1, 4)
+            boxoverlaps = np.logical_and(
+                np.logical_and(regbounds[:, None, 0] <= regbounds[None, :, 2],
+                               regbounds[None, :, 0] <= regbounds[:, None, 2]),
+                np.logical_and(regbounds[:, None, 1] <= regbounds[None, :, 3],
+                               regbounds[None, :, 1] <= regbounds[:, None, 3]))
             for i in range(0, len(regpolys)):
                 for j in range(i+1, len(regpolys)):
+                    if not boxoverlaps[i, j]:
+                        continue
                     region1 = regpolys[i][0]
                     region2 = regpolys[j][0]
                     regpoly1 = regpolys[i][1]
@@ -248,12 +272,8 @@ class RepairSegmentation(Processor):
                                          self.parameter['plausibilize_merge_min_overlap'],
                                          page_id):
                         # non-trivial overlap: mutually plausibilize lines
-                        linepolys1 = sorted([(line, Polygon(polygon_from_points(line.get_Coords().points)))
-                                             for line in region1.get_TextLine()],
-                                            key=lambda x: x[1].area)
-                        linepolys2 = sorted([(line, Polygon(polygon_from_points(line.get_Coords().points)))
-                                             for line in region2.get_TextLine()],
-                                            key=lambda x: x[1].area)
+                        linepolys1 = get_linepolys(region1)
+                        linepolys2 = get_linepolys(region2)
                         for line1, linepoly1 in linepolys1:
                             for line2, linepoly2 in linepolys2:
                                 if _compare_segments(line1, line2, linepoly1, linepoly2,
@@ -284,7 +304,8 @@ class RepairSegmentation(Processor):
             _plausibilize_segments(regpolys, rogroup,
                                    marked_for_deletion,
                                    marked_for_merging,
-                                   marked_for_splitting)
+                                   marked_for_splitting,
+                                   linepolys=linepolys)
     
 def _compare_segments(seg1, seg2, poly1, poly2, marked_for_deletion, marked_for_merging, min_overlap, page_id):
     """Determine redundancies in a pair of regions/lines
@@ -432,7 +453,7 @@ def _merge_segments(seg, superseg, poly, superpoly, segpolys, reading_order):
             seg.id, seg.get_TextEquiv(), # FIXME needs repr...
             superseg.id, superseg.get_TextEquiv())) # ...to be informative
         
-def _plausibilize_segments(segpolys, rogroup, marked_for_deletion, marked_for_merging, marked_for_splitting):
+def _plausibilize_segments(segpolys, rogroup, marked_for_deletion, marked_for_merging, marked_for_splitting, linepolys=None):
     """Remove redundancy among a set of segments by applying deletion/merging/splitting
     
     \b
@@ -450,9 +471,14 @@ def _plausibilize_segments(segpolys, rogroup, marked_for_deletion, marked_for_me
     page_get_reading_order(reading_order, rogroup)
     for seg, poly in segpolys:
         if isinstance(seg, TextRegionType):
-            # plausibilize lines first
-            _plausibilize_segments([(line, Polygon(polygon_from_points(line.get_Coords().points)))
-                                 for line in seg.get_TextLine()], None,
+            # plausibilize lines first, re-using the polygons cached during
+            # comparison where possible (also area-sorted, which gives the
+            # same total ordering rationale as for the regions above)
+            seglinepolys = (linepolys or {}).get(seg.id)
+            if seglinepolys is None:
+                seglinepolys = [(line, Polygon(polygon_from_points(line.get_Coords().points)))
+                                for line in seg.get_TextLine()]
+            _plausibilize_segments(seglinepolys, None,
                                 marked_for_deletion, marked_for_merging, marked_for_splitting)
         delete = seg.id in marked_for_deletion
         merge = seg.id in marked_for_merging
@@ -522,29 +548,39 @@ def page_get_reading_order(ro, rogroup):
 def shrink_regions(page_image, page_coords, page, page_id, padding=0):
     """Shrink each region outline to become the minimal concave hull of its binary foreground."""
     LOG = getLogger('processor.RepairSegmentation')
-    page_array = ~ np.array(page_image.convert('1'))
+    regions = page.get_AllRegions()
+    if not regions:
+        # nothing to do - avoid rasterizing and labelling the page
+        return
+    # collapse to grayscale and threshold in one vectorized pass
+    # (cheaper than PIL's mode '1' conversion, which also dithers)
+    page_array = np.asarray(page_image.convert('L')) <= 127
     page_polygon = page_poly(page)
     if page.get_Border():
         page_polygon = Polygon(polygon_from_points(page.get_Border().get_Coords().points))
     # estimate glyph scale (roughly)
-    _, components = cv2.connectedComponents(page_array.astype(np.uint8))
-    _, counts = np.unique(components, return_counts=True)
-    if counts.shape[0] > 1:
-        counts = np.sqrt(3 * counts)
+    # (get component areas directly from the stats instead of
+    #  counting labels in an extra full-page np.unique pass)
+    n_components, _, stats, _ = cv2.connectedComponentsWithStats(page_array.astype(np.uint8))
+    if n_components > 1:
+        counts = np.sqrt(3 * stats[:, cv2.CC_STAT_AREA])
         counts = counts[(5 < counts) & (counts < 100)]
         scale = int(np.median(counts))
     else:
         scale = 43
-    for region in page.get_AllRegions():
+    for region in regions:
         #LOG.info('Shrinking region "%s"', region.id)
-        region_mask = np.zeros_like(page_array, dtype=np.bool)
         region_polygon = coordinates_of_segment(region, page_image, page_coords)
-        region_mask[draw.polygon(region_polygon[:, 1],
-                                 region_polygon[:, 0],
-                                 region_mask.shape)] = True
+        # rasterize via OpenCV (much faster than skimage.draw.polygon)
+        region_mask = np.zeros(page_array.shape, np.uint8)
+        cv2.fillPoly(region_mask, [np.round(region_polygon).astype(np.int32)], 1)
         # find outer contour (parts):
-        region_array = page_array & region_mask
-        contours, _ = cv2.findContours(region_array.astype(np.uint8),
+        region_array = page_array & (region_mask > 0)
+        # close small gaps between glyph components in one morphological pass,
+        # so much fewer contour parts remain to be joined below
+        region_array = cv2.morphologyEx(region_array.astype(np.uint8), cv2.MORPH_CLOSE,
+                                        np.ones((max(1, scale // 2),) * 2, np.uint8))
+        contours, _ = cv2.findContours(region_array,
                                        cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
         # determine areas of parts:
         areas = [cv2.contourArea(contour) for contour in contours]
@@ -558,7 +594,9 @@ def shrink_regions(page_image, page_coords, page, page_id, padding=0):
                                         for contour in contours
                                         if len(contour) >= 3], scale=scale)
         if padding:
-            region_polygon = region_polygon.buffer(padding)
+            # mitred join instead of the (default) round join:
+            # equally effective, but adds no interpolation points
+            region_polygon = region_polygon.buffer(padding, join_style=JOIN_STYLE.mitre)
         region_polygon = coordinates_for_segment(region_polygon.exterior.coords[:-1], page_image, page_coords)
         region_polygon = Polygon(region_polygon)
         if not region_polygon.within(page_polygon):
@@ -720,6 +758,17 @@ def ensure_valid(element):
 
 def make_valid(polygon):
     """Ensures shapely.geometry.Polygon object is valid by repeated simplification"""
+    if polygon.is_valid:
+        return polygon
+    if shapely_make_valid is not None:
+        # single GEOS pass instead of the repeated-simplification loop below
+        valid = shapely_make_valid(polygon)
+        if valid.type in ['MultiPolygon', 'GeometryCollection']:
+            # keep the largest polygonal part
+            valid = max([geom for geom in valid.geoms if geom.type == 'Polygon'],
+                        key=lambda geom: geom.area, default=polygon)
+        if valid.type == 'Polygon':
+            return valid
     for split in range(1, len(polygon.exterior.coords)-1):
         if polygon.is_valid or polygon.simplify(polygon.area).is_valid:
             break